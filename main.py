@@ -6,13 +6,21 @@
 import os
 import sys
 import subprocess
+import importlib.util
+import csv
+import hashlib
 import json
 import math
+import string
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Set
 
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # 自動安裝必要的套件
 def setup_packages():
@@ -24,20 +32,55 @@ def setup_packages():
         'pandas': 'pandas'
     }
     
-    for module_name, package_name in required_packages.items():
-        try:
-            __import__(module_name)
-            print(f"✓ {package_name} 已安裝")
-        except ImportError:
-            print(f"✗ 正在安裝 {package_name}...")
-            subprocess.check_call([sys.executable, '-m', 'pip', 'install', package_name, '-q'])
-            print(f"✓ {package_name} 安裝完成")
+    missing = [
+        package_name for module_name, package_name in required_packages.items()
+        if importlib.util.find_spec(module_name) is None
+    ]
+    
+    if not missing:
+        print(f"✓ {', '.join(required_packages.values())} 已安裝")
+        return
+    
+    # 一次安裝所有缺少的套件，只需啟動一次 pip
+    print(f"✗ 正在安裝 {', '.join(missing)}...")
+    subprocess.check_call([sys.executable, '-m', 'pip', 'install', '-q', *missing])
+    print(f"✓ {', '.join(missing)} 安裝完成")
 
 # 執行套件設置
 setup_packages()
 
-import folium
-import pandas as pd
+# folium / pandas / numpy 載入較慢，延後到實際需要的方法內才匯入
+
+# orjson（選用）以 C 實作解析 JSON，較標準庫快；未安裝時退回標準庫
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# 輸出檔案的寫入緩衝區大小（1 MiB）
+WRITE_BUFFER_SIZE = 1 << 20
+
+# 測站 popup 內容模板
+POPUP_TEMPLATE = string.Template("""
+<div style="font-family: 微軟正黑體, sans-serif; width: 180px;">
+<p style="margin: 5px 0; font-size: 14px; font-weight: bold;">$site</p>
+<p style="margin: 3px 0; font-size: 12px; color: #666;">$county</p>
+<hr style="margin: 5px 0; border: none; border-top: 1px solid #ddd;">
+<p style="margin: 5px 0; font-size: 16px; font-weight: bold; color: $color;">AQI: $aqi</p>
+<p style="margin: 3px 0; font-size: 12px;">$level</p>
+</div>
+""")
+
+
+# 本次執行已建立（或確認存在）的目錄，避免重複的 mkdir 系統呼叫
+_ensured_dirs: Set[Path] = set()
+
+
+def _ensure_dir(path: Path):
+    """確保目錄存在，每個目錄只呼叫一次 mkdir"""
+    if path not in _ensured_dirs:
+        path.mkdir(parents=True, exist_ok=True)
+        _ensured_dirs.add(path)
 
 
 def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
@@ -69,18 +112,78 @@ class AQIDataFetcher:
     
     BASE_URL = "https://data.moenv.gov.tw/api/v2/aqx_p_432"
     
-    def __init__(self, api_key: str):
+    # 連線 / 讀取逾時秒數：連線失敗時快速放棄
+    TIMEOUT = (3, 10)
+    
+    # 快取有效秒數（環境部每小時更新一次），可用環境變數 AQI_CACHE_TTL 覆寫
+    CACHE_TTL = 3600
+    
+    def __init__(self, api_key: str, cache_dir: str = 'outputs/.cache'):
         """初始化 API 取得器
         
         Args:
             api_key: 環境部 API Key
+            cache_dir: 快取目錄
         """
         self.api_key = api_key
         self.session = requests.Session()
         
+        # 暫時性錯誤（限流、閘道錯誤）自動重試，並以退避間隔避免連續打擊伺服器；
+        # 忽略 Retry-After，避免伺服器要求長時間等待而卡住程式
+        retry = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 502, 503, 504],
+            respect_retry_after_header=False
+        )
+        self.session.mount('https://', HTTPAdapter(max_retries=retry, pool_maxsize=4))
+        self.cache_path = Path(cache_dir) / 'aqi.json'
+        
+        try:
+            self.cache_ttl = int(os.getenv('AQI_CACHE_TTL', self.CACHE_TTL))
+        except ValueError:
+            self.cache_ttl = self.CACHE_TTL
+    
+    def _cache_key(self, params: Dict) -> str:
+        """以 URL 與查詢參數產生快取鍵（避免將 API Key 明文寫入快取）"""
+        raw = self.BASE_URL + '?' + json.dumps(params, sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def _load_cache(self, key: str) -> Optional[Dict]:
+        """讀取快取，若不存在、損毀或鍵不符則返回 None"""
+        try:
+            cache = json.loads(self.cache_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return None
+        
+        if not isinstance(cache, dict) or cache.get('key') != key:
+            return None
+        return cache
+    
+    def _save_cache(self, key: str, records: List[Dict], response: requests.Response):
+        """以暫存檔 + os.replace 原子寫入快取"""
+        cache = {
+            'key': key,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'records': records
+        }
+        
+        try:
+            _ensure_dir(self.cache_path.parent)
+            tmp_path = self.cache_path.with_suffix(self.cache_path.suffix + '.tmp')
+            tmp_path.write_text(json.dumps(cache, ensure_ascii=False), encoding='utf-8')
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"⚠ 無法寫入快取: {e}")
+        
     def fetch_aqi_data(self, limit: int = 1000) -> Optional[List[Dict]]:
         """取得全台 AQI 數據
         
+        快取未過期時直接使用本地快取；過期時以 ETag / Last-Modified
+        向伺服器確認，若回應 304 則沿用快取並更新其時間戳記；
+        重試後仍連線失敗時，退回使用過期快取。
+        
         Args:
             limit: 取得數據筆數上限
             
@@ -94,12 +197,40 @@ class AQIDataFetcher:
             'order': 'desc'
         }
         
+        key = self._cache_key(params)
+        cache = self._load_cache(key)
+        
+        if cache is not None:
+            age = time.time() - self.cache_path.stat().st_mtime
+            if age < self.cache_ttl:
+                records = cache.get('records', [])
+                print(f"✓ 使用快取數據 {len(records)} 筆（{int(age)} 秒前取得）")
+                return records
+        
+        headers = {}
+        if cache is not None:
+            if cache.get('etag'):
+                headers['If-None-Match'] = cache['etag']
+            if cache.get('last_modified'):
+                headers['If-Modified-Since'] = cache['last_modified']
+        
         try:
             print("⏳ 正在取得環境部 AQI 數據...")
-            response = self.session.get(self.BASE_URL, params=params, timeout=10)
+            response = self.session.get(self.BASE_URL, params=params, headers=headers, timeout=self.TIMEOUT)
+            
+            if response.status_code == 304 and cache is not None:
+                # 資料未變動，更新快取時間戳記即可
+                try:
+                    os.utime(self.cache_path)
+                except OSError as e:
+                    print(f"⚠ 無法更新快取時間戳記: {e}")
+                records = cache.get('records', [])
+                print(f"✓ 數據未更新，沿用快取 {len(records)} 筆")
+                return records
+            
             response.raise_for_status()
             
-            data = response.json()
+            data = json_loads(response.content)
             
             # API 可能直接返回列表或包含 records 的字典
             if isinstance(data, list):
@@ -114,11 +245,19 @@ class AQIDataFetcher:
                 print("✗ 無效的 API 返回格式")
                 return None
             
+            # 空結果不寫入快取，下次執行仍會重新向 API 取得
+            if records:
+                self._save_cache(key, records, response)
+            
             print(f"✓ 成功取得 {len(records)} 筆測站數據")
             return records
                 
         except requests.exceptions.RequestException as e:
             print(f"✗ 網路請求失敗: {e}")
+            if cache is not None:
+                records = cache.get('records', [])
+                print(f"⚠ 使用過期快取 {len(records)} 筆")
+                return records
             return None
         except json.JSONDecodeError:
             print("✗ 無法解析 API 回應")
@@ -139,6 +278,13 @@ class AQIMapVisualizer:
         (101, 500, '不健康', '#ff4444')  # 紅色
     ]
     
+    # 預先展開的查表：_AQI_LUT[i] 為整數 AQI 值 i（0-500）對應的 (等級, 顏色)
+    _AQI_LUT = [
+        (level, color)
+        for min_val, max_val, level, color in AQI_LEVELS
+        for _ in range(min_val, max_val + 1)
+    ]
+    
     def __init__(self, output_dir: str = 'outputs'):
         """初始化地圖視覺化器
         
@@ -146,7 +292,7 @@ class AQIMapVisualizer:
             output_dir: 輸出目錄
         """
         self.output_dir = Path(output_dir)
-        self.output_dir.mkdir(exist_ok=True)
+        _ensure_dir(self.output_dir)
     
     def get_aqi_level(self, aqi: float) -> tuple:
         """根據 AQI 值取得對應等級
@@ -162,12 +308,42 @@ class AQIMapVisualizer:
         except (ValueError, TypeError):
             return '未知', '#95a5a6'
         
-        for min_val, max_val, level, color in self.AQI_LEVELS:
-            if min_val <= aqi_val <= max_val:
-                return level, color
+        if math.isnan(aqi_val):
+            return '未知', '#95a5a6'
+        
+        # 小數值歸入其整數所在的等級
+        if 0 <= aqi_val < len(self._AQI_LUT):
+            return self._AQI_LUT[int(aqi_val)]
         
         return '危害', '#4b0082'
     
+    def get_aqi_levels(self, aqi_values: List) -> tuple:
+        """批次取得多個 AQI 值的對應等級（get_aqi_level 的向量化版本）
+        
+        Args:
+            aqi_values: AQI 值列表
+            
+        Returns:
+            (等級名稱陣列, 顏色陣列) 的 tuple
+        """
+        import numpy as np
+        import pandas as pd
+        
+        # 空值視為 0，無法轉換的值為 NaN
+        values = pd.Series(list(aqi_values), dtype=object)
+        aqi = pd.to_numeric(values.where(values.astype(bool), 0), errors='coerce').to_numpy(dtype=np.float64)
+        
+        # 依各等級上限分箱：0-50 → 0、51-100 → 1、101-500 → 2、>500 → 3（危害）
+        upper_bounds = [max_val for _, max_val, _, _ in self.AQI_LEVELS]
+        idx = np.searchsorted(upper_bounds, np.floor(aqi), side='left')
+        idx[aqi < 0] = len(self.AQI_LEVELS)
+        idx[np.isnan(aqi)] = len(self.AQI_LEVELS) + 1
+        
+        levels = np.array([level for _, _, level, _ in self.AQI_LEVELS] + ['危害', '未知'])
+        colors = np.array([color for _, _, _, color in self.AQI_LEVELS] + ['#4b0082', '#95a5a6'])
+        
+        return levels[idx].tolist(), colors[idx].tolist()
+    
     def create_map(self, records: List[Dict], output_file: str = 'aqi_map.html') -> str:
         """根據 AQI 數據創建地圖
         
@@ -178,6 +354,10 @@ class AQIMapVisualizer:
         Returns:
             輸出檔案路徑
         """
+        import folium
+        import numpy as np
+        import pandas as pd
+        
         # 篩選有效的測站數據（處理大小寫變化）
         valid_records = [
             r for r in records 
@@ -201,44 +381,49 @@ class AQIMapVisualizer:
             tiles='OpenStreetMap'
         )
         
+        # 預先計算每個測站的等級與顏色
+        levels, colors = self.get_aqi_levels([r.get('aqi') for r in valid_records])
+        
+        # 一次轉換所有經緯度，無法轉換的座標為 NaN 並事先排除
+        lats = pd.to_numeric(pd.Series([r.get('latitude') for r in valid_records]), errors='coerce').to_numpy(dtype=np.float64)
+        lons = pd.to_numeric(pd.Series([r.get('longitude') for r in valid_records]), errors='coerce').to_numpy(dtype=np.float64)
+        valid_idx = np.flatnonzero(~(np.isnan(lats) | np.isnan(lons)))
+        
+        skipped = len(valid_records) - len(valid_idx)
+        if skipped:
+            print(f"⚠ 跳過 {skipped} 筆座標無效的測站數據")
+        
+        # 所有測站標記放入同一個 FeatureGroup，最後只加入地圖一次
+        stations = folium.FeatureGroup(name='stations')
+        
         # 添加測站標記
-        for record in valid_records:
-            try:
-                lat = float(record['latitude'])
-                lon = float(record['longitude'])
-                site_name = record.get('sitename', '未知測站')
-                county = record.get('county', '')
-                aqi = record.get('aqi', 'N/A')
-                
-                level, color = self.get_aqi_level(aqi)
-                
-                # 創建簡潔的 popup 內容
-                popup_text = f"""
-                <div style="font-family: 微軟正黑體, sans-serif; width: 180px;">
-                <p style="margin: 5px 0; font-size: 14px; font-weight: bold;">{site_name}</p>
-                <p style="margin: 3px 0; font-size: 12px; color: #666;">{county}</p>
-                <hr style="margin: 5px 0; border: none; border-top: 1px solid #ddd;">
-                <p style="margin: 5px 0; font-size: 16px; font-weight: bold; color: {color};">AQI: {aqi}</p>
-                <p style="margin: 3px 0; font-size: 12px;">{level}</p>
-                </div>
-                """
-                
-                # 添加圓形標記
-                folium.CircleMarker(
-                    location=[lat, lon],
-                    radius=10,
-                    popup=folium.Popup(popup_text, max_width=200),
-                    color=color,
-                    fill=True,
-                    fillColor=color,
-                    fillOpacity=0.8,
-                    weight=2,
-                    tooltip=f"{site_name} - AQI: {aqi}"
-                ).add_to(m)
-                
-            except (ValueError, TypeError) as e:
-                print(f"⚠ 跳過無效數據: {record.get('SiteName', 'Unknown')} - {e}")
-                continue
+        for i in valid_idx:
+            record = valid_records[i]
+            level = levels[i]
+            color = colors[i]
+            site_name = record.get('sitename', '未知測站')
+            county = record.get('county', '')
+            aqi = record.get('aqi', 'N/A')
+            
+            # 創建簡潔的 popup 內容
+            popup_text = POPUP_TEMPLATE.safe_substitute(
+                site=site_name, county=county, color=color, aqi=aqi, level=level
+            )
+            
+            # 添加圓形標記
+            stations.add_child(folium.CircleMarker(
+                location=[float(lats[i]), float(lons[i])],
+                radius=10,
+                popup=folium.Popup(popup_text, max_width=200),
+                color=color,
+                fill=True,
+                fillColor=color,
+                fillOpacity=0.8,
+                weight=2,
+                tooltip=f"{site_name} - AQI: {aqi}"
+            ))
+        
+        m.add_child(stations)
         
         # 添加簡潔圖例
         legend_html = '''
@@ -257,8 +442,20 @@ class AQIMapVisualizer:
         m.get_root().html.add_child(folium.Element(legend_html))
         
         # 保存地圖
+        # 先寫入暫存檔再替換，避免中斷時留下不完整的地圖
         output_path = self.output_dir / output_file
-        m.save(str(output_path))
+        _ensure_dir(output_path.parent)
+        tmp_path = output_path.with_suffix(output_path.suffix + '.tmp')
+        try:
+            html = m.get_root().render()
+            with open(tmp_path, 'w', encoding='utf-8', newline='', buffering=WRITE_BUFFER_SIZE) as f:
+                # 分段寫入，避免一次將整份 HTML 編碼成另一份同樣大小的 bytes
+                for start in range(0, len(html), WRITE_BUFFER_SIZE):
+                    f.write(html[start:start + WRITE_BUFFER_SIZE])
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
         print(f"✓ 地圖已保存: {output_path}")
         
         return str(output_path)
@@ -270,36 +467,53 @@ class AQIMapVisualizer:
             records: AQI 數據記錄列表
             output_file: 輸出檔案名稱
         """
+        import numpy as np
+        import pandas as pd
+        
         try:
-            df = pd.DataFrame(records)
-            
             # 台北車站座標
             taipei_station_lat = 25.0478
             taipei_station_lon = 121.5170
             
-            # 計算距離
-            df['距台北車站(公里)'] = df.apply(
-                lambda row: calculate_distance(
-                    float(row['latitude']), 
-                    float(row['longitude']),
-                    taipei_station_lat,
-                    taipei_station_lon
-                ) if pd.notna(row['latitude']) and pd.notna(row['longitude']) else None,
-                axis=1
-            )
+            # 計算距離（向量化 Haversine，與 calculate_distance 相同公式）
+            lat = pd.to_numeric(pd.Series([r.get('latitude') for r in records]), errors='coerce').to_numpy(dtype=np.float64)
+            lon = pd.to_numeric(pd.Series([r.get('longitude') for r in records]), errors='coerce').to_numpy(dtype=np.float64)
+            
+            lat1_rad = np.radians(lat)
+            lat2_rad = np.radians(taipei_station_lat)
+            delta_lat = np.radians(taipei_station_lat - lat)
+            delta_lon = np.radians(taipei_station_lon - lon)
             
-            # 選擇重要欄位
-            columns = ['sitename', 'county', 'aqi', 'pollutant', 'status', 'latitude', 'longitude', '距台北車站(公里)', 'publishtime']
-            available_columns = [col for col in columns if col in df.columns]
-            df_output = df[available_columns]
+            a = np.sin(delta_lat/2)**2 + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(delta_lon/2)**2
+            distance = 2 * 6371 * np.arcsin(np.sqrt(a))
+            distances = [None if math.isnan(d) else d for d in np.round(distance, 2).tolist()]
             
-            # 按距離排序
-            df_output = df_output.sort_values('距台北車站(公里)')
+            # 選擇重要欄位，數據量小，直接以 csv 模組輸出而不建立 DataFrame
+            header = ['sitename', 'county', 'aqi', 'pollutant', 'status', 'latitude', 'longitude', '距台北車站(公里)', 'publishtime']
+            rows = [
+                (r.get('sitename'), r.get('county'), r.get('aqi'), r.get('pollutant'), r.get('status'),
+                 r.get('latitude'), r.get('longitude'), d, r.get('publishtime'))
+                for r, d in zip(records, distances)
+            ]
             
+            # 按距離排序（無法計算距離者排在最後）
+            rows.sort(key=lambda row: (row[7] is None, row[7] or 0))
+            
+            # 先寫入暫存檔再替換，避免中斷時留下不完整的報告
             output_path = self.output_dir / output_file
-            df_output.to_csv(output_path, index=False, encoding='utf-8-sig')
+            _ensure_dir(output_path.parent)
+            tmp_path = output_path.with_suffix(output_path.suffix + '.tmp')
+            try:
+                with open(tmp_path, 'w', encoding='utf-8-sig', newline='', buffering=WRITE_BUFFER_SIZE) as f:
+                    writer = csv.writer(f, lineterminator='\n')
+                    writer.writerow(header)
+                    writer.writerows(rows)
+                os.replace(tmp_path, output_path)
+            except BaseException:
+                tmp_path.unlink(missing_ok=True)
+                raise
             print(f"✓ 數據報告已保存: {output_path}")
-            print(f"  最近測站: {df_output.iloc[0]['sitename']} ({df_output.iloc[0]['距台北車站(公里)']} 公里)")
+            print(f"  最近測站: {rows[0][0]} ({rows[0][7]} 公里)")
             
         except Exception as e:
             print(f"⚠ 創建數據報告失敗: {e}")
@@ -320,18 +534,25 @@ def main():
         print("  請在 .env 檔案中添加: MOENV_API_KEY=你的API金鑰")
         return
     
-    # 取得數據
+    # 取得數據（主執行緒，Ctrl-C 可立即中斷），同時在背景執行緒預先載入地圖與報告所需套件
     fetcher = AQIDataFetcher(api_key)
-    records = fetcher.fetch_aqi_data()
-    fetcher.close()
+    executor = ThreadPoolExecutor(max_workers=1)
+    records = None
+    try:
+        for module_name in ('numpy', 'pandas', 'folium'):
+            executor.submit(importlib.import_module, module_name)
+        
+        visualizer = AQIMapVisualizer()
+        records = fetcher.fetch_aqi_data()
+    finally:
+        fetcher.close()
+        # 取得失敗或中斷時不再等待，並取消尚未開始的套件載入
+        executor.shutdown(wait=bool(records), cancel_futures=not records)
     
     if not records:
         print("✗ 無法取得 AQI 數據")
         return
     
-    # 視覺化
-    visualizer = AQIMapVisualizer()
-    
     # 創建地圖
     map_file = visualizer.create_map(records)
     